@@ -1,87 +1,354 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from fastapi import APIRouter, File, Header, UploadFile, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
 import os
 import shutil
+from collections import OrderedDict
 from pathlib import Path
+import secrets
 import subprocess
-import uuid
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel
+from core.ffprobe_cache import clip_metadata, probe_many
+from core.responses import video_response
+from core.thumbnails import generate_thumbnail
+from core.processor import (
+    build_concat_demuxer_command,
+    can_copy_trim,
+    concat_copy_trimmed,
+    build_filter_concat_command,
+    faststart,
+    run_ffmpeg,
+    streams_match,
+    write_concat_list,
+)
 
 class ConcatenateRequest(BaseModel):
     clip_ids: List[str]
-    output_filename: str = None  # Optional, we'll generate if not provided
+    output_filename: Optional[str] = None  # Optional, we'll generate if not provided
+    trim_first_frame: bool = True  # Drop the repeated first frame of every clip after the first
 
 router = APIRouter(prefix="/api/clips")
 
-# In-memory storage for clip metadata
-clips = {}
-clip_counter = 0
+# In-memory storage for clip metadata, oldest upload first. The order is also
+# the listing order the frontend concatenates in, so reads must not reorder it
+clips = OrderedDict()
+MAX_CLIPS = 500
 
-# Create directory if it doesn't exist
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+# os.stat results taken at upload, reused when serving the file
+clip_stats = {}
 
-OUTPUT_DIR = Path("output")
-OUTPUT_DIR.mkdir(exist_ok=True)
+# Progress of in-flight concatenations, keyed by output filename
+jobs = {}
+
+# One bounded queue per WebSocket listener so a slow client can't hold up the rest
+progress_listeners = set()
+PROGRESS_QUEUE_SIZE = 16
+
+# Resolved once, not per request. Created by ensure_directories() at startup
+UPLOAD_DIR = Path("uploads").resolve()
+OUTPUT_DIR = Path("output").resolve()
+THUMBNAIL_DIR = Path("thumbnails").resolve()
+
+# Thumbnails are made by one background worker draining this queue, so uploads
+# never wait on ffmpeg and thumbnail jobs can't pile up on the CPU. Each clip
+# gets one future that resolves to whether its thumbnail was written
+thumbnail_queue: asyncio.Queue = None
+thumbnail_jobs: Dict[str, asyncio.Future] = {}
+
+UPLOAD_COPY_BUFSIZE = 2 * 1024 * 1024  # 2 MiB
+MAX_UPLOAD_SIZE = 500 * 1024 * 1024  # 500 MiB
+
+def store_clip(clip_id: str, clip: dict):
+    clips[clip_id] = clip
+    
+    # Evict the oldest uploads once over the limit
+    while len(clips) > MAX_CLIPS:
+        old_id, old_clip = clips.popitem(last=False)
+        clip_stats.pop(old_id, None)
+        job = thumbnail_jobs.pop(old_id, None)
+        if job is not None and not job.done():
+            job.set_result(False)  # Wake anyone still waiting on the thumbnail
+        (THUMBNAIL_DIR / f"{old_id}.jpg").unlink(missing_ok=True)
+        Path(old_clip["file_path"]).unlink(missing_ok=True)
+
+def ensure_directories():
+    UPLOAD_DIR.mkdir(exist_ok=True)
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    THUMBNAIL_DIR.mkdir(exist_ok=True)
+
+def _save_upload(src, dst: Path) -> int:
+    # The body is already spooled by the time we get here, so the size is known
+    src.seek(0, os.SEEK_END)
+    size = src.tell()
+    src.seek(0)
+    if size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File too large")
+    
+    with open(dst, "wb") as buffer:
+        # A spool that has rolled over to disk can be copied entirely in-kernel
+        if getattr(src, "_rolled", False):
+            try:
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(buffer.fileno(), src.fileno(), offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+                return offset
+            except OSError:
+                # sendfile to a regular file isn't supported everywhere (e.g. macOS)
+                src.seek(0)
+                buffer.seek(0)
+                buffer.truncate()
+        
+        shutil.copyfileobj(src, buffer, UPLOAD_COPY_BUFSIZE)
+    return size
+
+def _upload_target(file: UploadFile) -> Tuple[str, str, Path]:
+    # The original name is display metadata only
+    filename = Path(file.filename or "").name
+    
+    # Stored under the clip id, so uploading the same name again never
+    # overwrites a file (and cached stat) that an older clip still serves.
+    # Random ID, no shared counter to race on across workers
+    clip_id = secrets.token_hex(8)
+    return clip_id, filename, UPLOAD_DIR / f"{clip_id}{Path(filename).suffix}"
+
+async def _register_clips(uploads: List[Tuple[str, str, Path]]) -> List[dict]:
+    paths = [str(file_path) for _, _, file_path in uploads]
+    
+    # Move a trailing moov to the front before anything reads the file
+    await asyncio.gather(*(faststart(path) for path in paths))
+    
+    # One stat per file, shared by the probe cache key and the video responses
+    stats = await run_in_threadpool(lambda: [os.stat(path) for path in paths])
+    
+    # Probe once here so concatenation never has to run ffprobe. A batch of
+    # uploads is probed concurrently in a single probe_many call
+    probe_results = await probe_many(paths, stats)
+    
+    registered = []
+    for (clip_id, filename, file_path), st, probe_result in zip(uploads, stats, probe_results):
+        clip_stats[clip_id] = st
+        
+        # Store metadata in memory
+        store_clip(clip_id, {
+            "id": clip_id,
+            "filename": filename,
+            "file_path": str(file_path),
+            "file_size": clip_stats[clip_id].st_size,
+            **clip_metadata(probe_result)
+        })
+        registered.append(clips[clip_id])
+        queue_thumbnail(clip_id)
+    
+    return registered
 
 @router.post("/upload")
 async def upload_clip(file: UploadFile = File(...)):
-    global clip_counter
+    target = _upload_target(file)
     
-    # Generate simple clip ID
-    clip_counter += 1
-    clip_id = f"clip_{clip_counter}"
+    # One threadpool hop for the whole copy keeps the event loop free
+    await run_in_threadpool(_save_upload, file.file, target[2])
+    clip, = await _register_clips([target])
     
-    # Save file to uploads directory
-    file_path = UPLOAD_DIR / file.filename
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    return {"message": "File uploaded successfully", "clip": clip}
+
+@router.post("/upload/batch")
+async def upload_clips(files: List[UploadFile] = File(...)):
+    # Assign an id and target path to every file before writing any of them
+    targets = [_upload_target(file) for file in files]
     
-    # Store metadata in memory
-    clips[clip_id] = {
-        "id": clip_id,
-        "filename": file.filename,
-        "file_path": str(file_path),
-        "file_size": file_path.stat().st_size
-    }
+    results = await asyncio.gather(*(
+        run_in_threadpool(_save_upload, file.file, file_path)
+        for file, (_, _, file_path) in zip(files, targets)
+    ), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            # All or nothing, don't leave files on disk with no clip pointing at them
+            await run_in_threadpool(lambda: [file_path.unlink(missing_ok=True) for _, _, file_path in targets])
+            raise result
+    registered = await _register_clips(targets)
     
-    return {"message": "File uploaded successfully", "clip": clips[clip_id]}
+    return {"message": f"{len(registered)} files uploaded successfully", "clips": registered}
+
+# The list view only needs these, the full record is served per clip
+SUMMARY_FIELDS = ("id", "filename", "file_size", "duration")
 
 @router.get("/")
 async def list_clips():
-    return {"clips": list(clips.values())}
+    return {"clips": [{key: clip[key] for key in SUMMARY_FIELDS} for clip in clips.values()]}
 
 @router.get("/{clip_id}/video")
-async def get_clip_video(clip_id: str):
+async def get_clip_video(clip_id: str, range_header: str = Header(None, alias="range")):
     if clip_id not in clips:
         raise HTTPException(status_code=404, detail=f"Clip {clip_id} not found")
     
     clip = clips[clip_id]
-    file_path = clip["file_path"]
-    
-    if not os.path.exists(file_path):
+    # The cached stat supplies the headers, but the file may have been removed
+    # since upload. Check before any headers go out
+    if not await run_in_threadpool(os.path.isfile, clip["file_path"]):
         raise HTTPException(status_code=404, detail="Video file not found on disk")
     
+    return video_response(clip["file_path"], clip_stats[clip_id], range_header, clip["filename"])
+
+def _write_thumbnail(path: Path, jpeg: bytes):
+    # Raw fd write, the bytes are already in memory so buffering buys nothing
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, jpeg)
+    finally:
+        os.close(fd)
+
+def queue_thumbnail(clip_id: str) -> asyncio.Future:
+    # Idempotent, a clip is only ever queued once
+    if clip_id not in thumbnail_jobs:
+        thumbnail_jobs[clip_id] = asyncio.get_running_loop().create_future()
+        thumbnail_queue.put_nowait(clip_id)
+    return thumbnail_jobs[clip_id]
+
+async def _make_thumbnail(clip_id: str) -> bool:
+    clip = clips.get(clip_id)
+    if clip is None:
+        return False  # Evicted while waiting in the queue
+    
+    jpeg = await generate_thumbnail(clip["file_path"], clip["duration"])
+    if jpeg is None or clip_id not in clips:
+        return False
+    await run_in_threadpool(_write_thumbnail, THUMBNAIL_DIR / f"{clip_id}.jpg", jpeg)
+    return True
+
+async def _thumbnail_worker():
+    while True:
+        clip_id = await thumbnail_queue.get()
+        future = thumbnail_jobs.get(clip_id)
+        try:
+            done = await _make_thumbnail(clip_id)
+        except Exception:
+            done = False
+        if future is not None and not future.done():
+            future.set_result(done)
+
+def start_thumbnail_worker() -> asyncio.Task:
+    global thumbnail_queue
+    thumbnail_queue = asyncio.Queue()
+    return asyncio.create_task(_thumbnail_worker())
+
+@router.get("/{clip_id}/status")
+async def get_clip_status(clip_id: str):
+    if clip_id not in clips:
+        raise HTTPException(status_code=404, detail=f"Clip {clip_id} not found")
+    
+    job = thumbnail_jobs.get(clip_id)
+    if job is None:
+        thumbnail = "missing"
+    elif not job.done():
+        thumbnail = "pending"
+    else:
+        thumbnail = "ready" if job.result() else "failed"
+    return {"id": clip_id, "thumbnail": thumbnail}
+
+@router.get("/{clip_id}/thumbnail")
+async def get_clip_thumbnail(clip_id: str):
+    if clip_id not in clips:
+        raise HTTPException(status_code=404, detail=f"Clip {clip_id} not found")
+    
+    # Normally already written by the worker after upload. If not, wait on
+    # the queued job instead of starting a second ffmpeg for the same clip
+    thumbnail_path = THUMBNAIL_DIR / f"{clip_id}.jpg"
+    try:
+        stat_result = await run_in_threadpool(os.stat, thumbnail_path)
+    except FileNotFoundError:
+        if not await queue_thumbnail(clip_id):
+            raise HTTPException(status_code=404, detail="Thumbnail not available")
+        stat_result = await run_in_threadpool(os.stat, thumbnail_path)
+    
+    # Clip ids are never reused, so the browser can cache this forever
     return FileResponse(
-        path=file_path,
-        media_type="video/mp4",
-        filename=clip["filename"]
+        path=str(thumbnail_path),
+        media_type="image/jpeg",
+        stat_result=stat_result,
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
     )
 
+def _scan_outputs():
+    # One scandir pass, DirEntry caches the stat so it's a single syscall per file
+    outputs = []
+    with os.scandir(OUTPUT_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".mp4") or not entry.is_file(follow_symlinks=False):
+                continue
+            st = entry.stat()
+            outputs.append({"filename": entry.name, "size": st.st_size, "modified": st.st_mtime})
+    outputs.sort(key=lambda output: output["modified"], reverse=True)
+    return outputs
+
+@router.get("/output")
+async def list_outputs():
+    return {"outputs": await run_in_threadpool(_scan_outputs)}
+
+def resolve_output_path(filename: str) -> Path:
+    # OUTPUT_DIR is resolved at import, so this is one resolve per request and
+    # also catches symlinks that point outside the output directory
+    output_path = (OUTPUT_DIR / filename).resolve()
+    if not output_path.is_relative_to(OUTPUT_DIR) or output_path == OUTPUT_DIR:
+        raise HTTPException(status_code=400, detail="Invalid output filename")
+    return output_path
+
 @router.get("/output/{filename}")
-async def get_output_video(filename: str):
-    output_path = OUTPUT_DIR / filename
+async def get_output_video(filename: str, range_header: str = Header(None, alias="range")):
+    output_path = resolve_output_path(filename)
     
-    if not output_path.exists():
+    # A single stat doubles as the existence check and the response headers
+    try:
+        stat_result = await run_in_threadpool(os.stat, output_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Output file not found")
     
-    return FileResponse(
-        path=str(output_path),
-        media_type="video/mp4",
-        filename=filename
-    )
+    return video_response(output_path, stat_result, range_header, filename)
+
+@router.get("/output/{filename}/progress")
+async def get_output_progress(filename: str):
+    if filename not in jobs:
+        raise HTTPException(status_code=404, detail="No concatenation in progress for this file")
+    
+    return jobs[filename]
+
+def broadcast_progress(message: dict):
+    for queue in progress_listeners:
+        if queue.full():
+            queue.get_nowait()  # Drop the oldest update rather than block
+        queue.put_nowait(message)
+
+def update_job(output_filename: str, update: dict):
+    jobs[output_filename].update(update)
+    broadcast_progress({"output_filename": output_filename, **jobs[output_filename]})
+
+async def _send_progress(websocket: WebSocket, queue: asyncio.Queue):
+    try:
+        while True:
+            await websocket.send_json(await queue.get())
+    except Exception:
+        pass  # Connection went away, the receive loop cleans up
+
+@router.websocket("/ws/progress")
+async def websocket_progress(websocket: WebSocket):
+    await websocket.accept()
+    queue = asyncio.Queue(maxsize=PROGRESS_QUEUE_SIZE)
+    progress_listeners.add(queue)
+    sender = asyncio.create_task(_send_progress(websocket, queue))
+    
+    try:
+        # Nothing is expected from the client, this just waits for the disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        progress_listeners.discard(queue)
+        sender.cancel()
 
 @router.post("/concatenate")
 async def concatenate_clips(request: ConcatenateRequest):
@@ -99,77 +366,82 @@ async def concatenate_clips(request: ConcatenateRequest):
         if not output_filename.endswith('.mp4'):
             output_filename += '.mp4'
     else:
-        output_filename = f"{uuid.uuid4().hex}.mp4"
+        output_filename = f"{secrets.token_hex(16)}.mp4"
     
-    output_path = OUTPUT_DIR / output_filename
+    output_path = resolve_output_path(output_filename)
     
-    # Get file paths in order
-    input_files = [clips[clip_id]["file_path"] for clip_id in request.clip_ids]
+    # Get clips and file paths in order
+    selected = [clips[clip_id] for clip_id in request.clip_ids]
+    input_files = [clip["file_path"] for clip in selected]
     
     if len(input_files) < 2:
         raise HTTPException(status_code=400, detail="Need at least 2 clips to concatenate")
     
     # Check if first video has audio (assuming all have same audio setup for now)
-    def has_audio_stream(video_file):
-        try:
-            result = subprocess.run([
-                "ffprobe", "-v", "quiet", "-select_streams", "a:0", 
-                "-show_entries", "stream=index", "-of", "csv=p=0", video_file
-            ], capture_output=True, text=True, check=True)
-            return bool(result.stdout.strip())
-        except:
-            return False
-    
-    has_audio = has_audio_stream(input_files[0])
-    
-    # Build FFmpeg command (adapted from joiner.py)
-    cmd = ["ffmpeg", "-y"]  # -y to overwrite output file
-    
-    # Add all input files
-    for video in input_files:
-        cmd.extend(["-i", video])
-    
-    # Build filter complex
-    filter_parts = []
-    concat_inputs = []
-    
-    for i, _ in enumerate(input_files):
-        if i == 0:
-            # First video: use as-is
-            concat_inputs.append(f"[{i}:v]")
-            if has_audio:
-                concat_inputs.append(f"[{i}:a]")
-        else:
-            # Subsequent videos: trim first frame (0.0625s for 16fps)
-            filter_parts.append(f"[{i}:v]trim=start_frame=1[{i}vtrim]")
-            concat_inputs.append(f"[{i}vtrim]")
-            if has_audio:
-                filter_parts.append(f"[{i}:a]atrim=start=0.0625[{i}atrim]")
-                concat_inputs.append(f"[{i}atrim]")
-    
-    # Combine all parts
-    filter_complex = ";".join(filter_parts)
-    if filter_parts:
-        filter_complex += ";"
-    
-    # Build concat filter
-    if has_audio:
-        filter_complex += "".join(concat_inputs) + f"concat=n={len(input_files)}:v=1:a=1[outv][outa]"
-        cmd.extend(["-filter_complex", filter_complex])
-        cmd.extend(["-map", "[outv]", "-map", "[outa]", str(output_path)])
+    has_audio = selected[0]["has_audio"]
+    
+    # Matching untrimmed clips can be stream copied via the concat demuxer, and
+    # trimmed ones too when every cut lands on a keyframe. Anything else has to
+    # go through the filter graph and be re-encoded
+    if request.trim_first_frame:
+        copy_trim = can_copy_trim(selected)
+        stream_copy = copy_trim
+    else:
+        copy_trim = False
+        stream_copy = streams_match(selected)
+    list_path = None
+    cmd = None
+    
+    if copy_trim:
+        trim_times = [None] + [clip["second_keyframe_time"] for clip in selected[1:]]
+    elif stream_copy:
+        list_path = OUTPUT_DIR / f"{output_path.stem}.txt"
+        cmd = build_concat_demuxer_command(list_path, output_path)
     else:
-        filter_complex += "".join(concat_inputs) + f"concat=n={len(input_files)}:v=1:a=0[outv]"
-        cmd.extend(["-filter_complex", filter_complex])
-        cmd.extend(["-map", "[outv]", str(output_path)])
+        cmd = build_filter_concat_command(
+            input_files, output_path, has_audio, request.trim_first_frame, selected[0]["fps"]
+        )
+    
+    # Progress is reported against the combined length of the inputs
+    total_duration = sum(clip["duration"] or 0 for clip in selected) or None
+    
+    # Claimed before the first await, two jobs must never write the same file
+    if output_filename in jobs:
+        raise HTTPException(status_code=409, detail=f"{output_filename} is already being rendered")
+    jobs[output_filename] = {}
+    update_job(output_filename, {"stage": "queued", "progress": 0.0})
+    
+    def on_progress(update):
+        update_job(output_filename, update)
     
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        if list_path:
+            await run_in_threadpool(write_concat_list, input_files, list_path)
+        if copy_trim:
+            await concat_copy_trimmed(input_files, trim_times, output_path, total_duration, on_progress)
+        else:
+            await run_ffmpeg(cmd, total_duration, on_progress)
+        update_job(output_filename, {"stage": "done", "progress": 100.0})
         return {
             "message": "Clips concatenated successfully",
             "output_filename": output_filename,
             "output_path": str(output_path),
             "had_audio": has_audio,
+            "stream_copied": stream_copy,
             "clips_processed": len(input_files)
         }
     except subprocess.CalledProcessError as e:
-        raise HTTPException(status_code=500, detail=f"FFmpeg error: {e.stderr}")
\ No newline at end of file
+        update_job(output_filename, {"stage": "failed"})
+        raise HTTPException(status_code=500, detail=f"FFmpeg error: {e.stderr}")
+    finally:
+        jobs.pop(output_filename, None)
+        if list_path:
+            list_path.unlink(missing_ok=True)
+
+# Registered last so the catch-all path doesn't shadow /output
+@router.get("/{clip_id}")
+async def get_clip(clip_id: str):
+    if clip_id not in clips:
+        raise HTTPException(status_code=404, detail=f"Clip {clip_id} not found")
+    
+    return clips[clip_id]
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import List
+
+# The first few packets tell us whether the second video frame is a keyframe
+PROBE_CMD = [
+    "ffprobe", "-v", "quiet", "-print_format", "json",
+    "-show_streams", "-show_format",
+    "-show_entries", "packet=stream_index,pts_time,flags",
+    "-read_intervals", "%+#8"
+]
+
+# Probe results keyed by (path, size, mtime) so a changed file is re-probed
+CACHE_SIZE = 512
+_cache = OrderedDict()
+
+logger = logging.getLogger(__name__)
+
+def _cache_key(path, st: os.stat_result = None):
+    if st is None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+    return (str(path), st.st_size, st.st_mtime_ns)
+
+def _remember(key, data: dict) -> dict:
+    _cache[key] = data
+    _cache.move_to_end(key)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return data
+
+async def _probe_async(path: str) -> dict:
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *PROBE_CMD, path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        logger.warning("ffprobe not found, skipping probe of %s", path)
+        return {}
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        logger.warning("ffprobe failed for %s", path)
+        return {}
+    return json.loads(stdout)
+
+async def probe_many(paths: List[str], stats: List[os.stat_result] = None) -> List[dict]:
+    # Probe every uncached file at once so N clips cost roughly one ffprobe run.
+    # Callers that have already stat'ed the files pass the results to skip a stat
+    stats = stats or [None] * len(paths)
+    keys = [_cache_key(path, st) for path, st in zip(paths, stats)]
+    missing = [key for key in dict.fromkeys(keys) if key is not None and key not in _cache]
+
+    results = await asyncio.gather(*(_probe_async(key[0]) for key in missing))
+    for key, data in zip(missing, results):
+        if data:
+            _remember(key, data)
+
+    return [_cache.get(key, {}) if key else {} for key in keys]
+
+def _parse_rate(rate):
+    # ffprobe reports frame rates as "num/den"
+    try:
+        num, den = (rate or "").split("/")
+        return float(num) / float(den) if float(den) else None
+    except ValueError:
+        return None
+
+def _second_keyframe_time(data: dict, video: dict):
+    # If the second video packet is a keyframe, a stream copy starting there
+    # drops exactly the first frame. Returned relative to the file start
+    packets = [
+        p for p in data.get("packets", [])
+        if p.get("stream_index") == video.get("index")
+    ]
+    if len(packets) < 2 or "K" not in packets[1].get("flags", ""):
+        return None
+    try:
+        start_time = float(data.get("format", {}).get("start_time", 0))
+        return float(packets[1]["pts_time"]) - start_time
+    except (KeyError, ValueError):
+        return None
+
+def clip_metadata(data: dict) -> dict:
+    # Flatten a probe result into the fields we keep on each clip
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    duration = data.get("format", {}).get("duration")
+
+    return {
+        "codec": video.get("codec_name"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "pix_fmt": video.get("pix_fmt"),
+        "fps": _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate")),
+        "time_base": video.get("time_base"),
+        "has_audio": audio is not None,
+        "audio_codec": audio.get("codec_name") if audio else None,
+        "sample_rate": int(audio["sample_rate"]) if audio and audio.get("sample_rate") else None,
+        "channels": audio.get("channels") if audio else None,
+        "duration": float(duration) if duration else None,
+        "second_keyframe_time": _second_keyframe_time(data, video) if video else None
+    }
@@ -0,0 +1,298 @@
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+# x264 scales well up to ~4 threads per encode, so run one job per 4 cores
+# instead of letting every request spawn its own ffmpeg
+FFMPEG_THREADS = 4
+MAX_FFMPEG_JOBS = max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+FFMPEG_SEM = asyncio.Semaphore(MAX_FFMPEG_JOBS)
+ffmpeg_jobs = {"running": 0, "waiting": 0}
+
+# Upload remuxes are stream copies bound by disk I/O, so they get their own
+# small limit instead of queueing behind re-encodes
+MAX_REMUX_JOBS = 2
+REMUX_SEM = asyncio.Semaphore(MAX_REMUX_JOBS)
+
+logger = logging.getLogger(__name__)
+
+# Frame rate assumed when a clip's metadata doesn't report one
+DEFAULT_FPS = 16
+
+@dataclass
+class ProcessingConfig:
+    # Encoder threads per job. 0 splits the cores evenly across the job pool;
+    # more threads per job beyond ~4 buys little, more concurrent jobs thrash
+    threads: int = 0
+    # Move the moov atom to the front so players can start before the download ends
+    faststart: bool = True
+    # Headroom for long concats where packets from one stream run ahead of another
+    max_muxing_queue_size: int = 1024
+
+    def resolved_threads(self) -> int:
+        return self.threads or max(1, (os.cpu_count() or 1) // MAX_FFMPEG_JOBS)
+
+PROCESSING_CONFIG = ProcessingConfig()
+
+def _output_args(config: ProcessingConfig, encode: bool) -> List[str]:
+    args = ["-max_muxing_queue_size", str(config.max_muxing_queue_size)]
+    if encode:
+        args.extend(["-threads", str(config.resolved_threads())])
+    if config.faststart:
+        args.extend(["-movflags", "+faststart"])
+    return args
+
+# Clip metadata fields that must be identical for the concat demuxer to stream copy
+STREAM_KEYS = (
+    "codec", "width", "height", "pix_fmt", "fps", "time_base",
+    "has_audio", "audio_codec", "sample_rate", "channels"
+)
+
+def streams_match(clips: List[dict]) -> bool:
+    # Stream copy is only safe when every clip has identical stream layouts
+    if not clips[0].get("codec"):
+        return False
+    first = tuple(clips[0].get(key) for key in STREAM_KEYS)
+    return all(tuple(clip.get(key) for key in STREAM_KEYS) == first for clip in clips[1:])
+
+def can_copy_trim(clips: List[dict]) -> bool:
+    # Dropping the first frame without re-encoding needs H.264 (for the Annex B
+    # TS remux), AAC or no audio, and a keyframe on frame 1 of every trimmed clip
+    return (
+        streams_match(clips)
+        and clips[0]["codec"] == "h264"
+        and clips[0]["audio_codec"] in (None, "aac")
+        and all(clip["second_keyframe_time"] for clip in clips[1:])
+    )
+
+def write_concat_list(input_files: List[str], list_path: Path):
+    with open(list_path, "w") as f:
+        for video in input_files:
+            # Concat demuxer quoting: close quote, escaped quote, reopen
+            escaped = str(Path(video).resolve()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+def build_concat_demuxer_command(list_path: Path, output_path: Path, config: ProcessingConfig = PROCESSING_CONFIG, ts_segments: bool = False) -> List[str]:
+    # No decoding at all - packets are copied straight into the new container
+    cmd = [
+        "ffmpeg", "-y", "-progress", "pipe:1", "-nostats", "-f", "concat", "-safe", "0", "-i", str(list_path),
+        "-c", "copy", *_output_args(config, encode=False)
+    ]
+    if ts_segments:
+        # ADTS AAC from the TS segments has to be repacked for mp4
+        cmd.extend(["-bsf:a", "aac_adtstoasc"])
+    cmd.append(str(output_path))
+    return cmd
+
+def build_segment_command(input_file: str, segment_path: Path, start_time: float = None) -> List[str]:
+    # Input seeking to a keyframe with stream copy is frame exact
+    cmd = ["ffmpeg", "-y", "-nostats"]
+    if start_time:
+        cmd.extend(["-ss", f"{start_time:.6f}"])
+    cmd.extend([
+        "-i", input_file, "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy",
+        "-bsf:v", "h264_mp4toannexb", "-f", "mpegts", str(segment_path)
+    ])
+    return cmd
+
+# ISO-BMFF containers, where the moov index may be written after the media
+MP4_SUFFIXES = frozenset({".mp4", ".mov", ".m4v"})
+
+def needs_faststart(path: str) -> bool:
+    # Walk the top-level boxes. With moov after mdat, the browser and every
+    # ffmpeg seek have to reach the end of the file before reading any frames
+    if Path(path).suffix.lower() not in MP4_SUFFIXES:
+        return False
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, box = int.from_bytes(header[:4], "big"), header[4:]
+                if box == b"moov":
+                    return False
+                if box == b"mdat":
+                    return True
+                if size == 1:
+                    # 64-bit size follows the header
+                    size = int.from_bytes(f.read(8), "big") - 8
+                if size < 8:
+                    # Box runs to the end of the file, or the file is malformed
+                    return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except OSError:
+        return False
+
+def build_faststart_command(input_file: str, output_file: str) -> List[str]:
+    # Stream copy of every track (subtitles, timecode and data included),
+    # only the moov box moves to the front
+    return [
+        "ffmpeg", "-y", "-nostats", "-i", input_file,
+        "-map", "0", "-c", "copy",
+        "-movflags", "+faststart", output_file
+    ]
+
+@functools.lru_cache(maxsize=64)
+def _filter_template(n: int, fps: float, trim_frames: int, has_audio: bool) -> Tuple[str, Tuple[str, ...]]:
+    # The graph only depends on the shape of the job, so repeat batches reuse it
+    filter_parts = []
+    concat_inputs = []
+    trim_time = trim_frames / fps
+    
+    for i in range(n):
+        if i == 0 or not trim_frames:
+            # First video: use as-is
+            concat_inputs.append(f"[{i}:v]")
+            if has_audio:
+                concat_inputs.append(f"[{i}:a]")
+        else:
+            # Subsequent videos: trim the leading frames (0.0625s per frame at 16fps)
+            filter_parts.append(f"[{i}:v]trim=start_frame={trim_frames}[{i}vtrim]")
+            concat_inputs.append(f"[{i}vtrim]")
+            if has_audio:
+                filter_parts.append(f"[{i}:a]atrim=start={trim_time:g}[{i}atrim]")
+                concat_inputs.append(f"[{i}atrim]")
+    
+    # Build concat filter and join every fragment once
+    if has_audio:
+        concat_filter = "".join(concat_inputs) + f"concat=n={n}:v=1:a=1[outv][outa]"
+        map_args = ("-map", "[outv]", "-map", "[outa]")
+    else:
+        concat_filter = "".join(concat_inputs) + f"concat=n={n}:v=1:a=0[outv]"
+        map_args = ("-map", "[outv]")
+    
+    return ";".join(filter_parts + [concat_filter]), map_args
+
+def build_filter_concat_command(input_files: List[str], output_path: Path, has_audio: bool, trim_first_frame: bool = True, fps: float = None, config: ProcessingConfig = PROCESSING_CONFIG) -> List[str]:
+    cmd = ["ffmpeg", "-y"]  # -y to overwrite output file
+    cmd.extend(["-progress", "pipe:1", "-nostats"])  # Machine readable progress on stdout
+    
+    # Add all input files
+    for video in input_files:
+        cmd.extend(["-i", video])
+    
+    filter_complex, map_args = _filter_template(
+        len(input_files), fps or DEFAULT_FPS, int(trim_first_frame), has_audio
+    )
+    cmd.extend(["-filter_complex", filter_complex])
+    cmd.extend(map_args)
+    
+    cmd.extend(_output_args(config, encode=True))
+    cmd.append(str(output_path))
+    return cmd
+
+def ffmpeg_pool_status() -> dict:
+    return {"max_jobs": MAX_FFMPEG_JOBS, "threads_per_job": PROCESSING_CONFIG.resolved_threads(), **ffmpeg_jobs}
+
+async def _read_progress(stream, total_duration, on_progress):
+    # -progress emits blocks of key=value lines, each closed by a progress= line
+    stats = {}
+    async for raw in stream:
+        key, _, value = raw.decode(errors="replace").strip().partition("=")
+        if key != "progress":
+            stats[key] = value
+            continue
+        
+        update = {"stage": "processing", "speed": stats.get("speed")}
+        try:
+            out_time = int(stats.get("out_time_us", "")) / 1_000_000
+        except ValueError:
+            out_time = None
+        if value == "end":
+            update["progress"] = 100.0
+        elif out_time is not None and total_duration:
+            update["progress"] = min(100.0, round(out_time / total_duration * 100, 1))
+        on_progress(update)
+
+async def _run_process(cmd: List[str], total_duration: float = None, on_progress: Callable[[dict], None] = None):
+    # Lazy %-formatting, the command is only joined when DEBUG is enabled
+    logger.debug("Executing FFmpeg: %s", cmd)
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    # Drain stderr alongside stdout so a full pipe can't stall ffmpeg
+    if on_progress:
+        stdout_reader = _read_progress(process.stdout, total_duration, on_progress)
+    else:
+        stdout_reader = process.stdout.read()
+    try:
+        _, stderr = await asyncio.gather(stdout_reader, process.stderr.read())
+        await process.wait()
+    except BaseException:
+        # Cancelled, or the progress callback raised. Don't leave ffmpeg
+        # running once its slot in the pool has been given back
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        raise
+    
+    if process.returncode != 0:
+        logger.error("FFmpeg exited with code %d", process.returncode)
+        raise subprocess.CalledProcessError(
+            process.returncode, cmd, stderr=stderr.decode(errors="replace")
+        )
+
+async def run_ffmpeg(cmd: List[str], total_duration: float = None, on_progress: Callable[[dict], None] = None):
+    # Wait for a free slot in the job pool before starting ffmpeg
+    ffmpeg_jobs["waiting"] += 1
+    try:
+        await FFMPEG_SEM.acquire()
+    finally:
+        ffmpeg_jobs["waiting"] -= 1
+    
+    ffmpeg_jobs["running"] += 1
+    try:
+        await _run_process(cmd, total_duration, on_progress)
+    finally:
+        ffmpeg_jobs["running"] -= 1
+        FFMPEG_SEM.release()
+
+async def concat_copy_trimmed(input_files: List[str], trim_times: List[float], output_path: Path, total_duration: float = None, on_progress: Callable[[dict], None] = None, config: ProcessingConfig = PROCESSING_CONFIG):
+    # Remux every clip into a TS segment starting at its trim point (in parallel,
+    # bounded by the job pool), then join the segments with the concat demuxer
+    work_dir = Path(await asyncio.to_thread(tempfile.mkdtemp, dir=output_path.parent))
+    try:
+        segments = [work_dir / f"{i}.ts" for i in range(len(input_files))]
+        results = await asyncio.gather(*(
+            run_ffmpeg(build_segment_command(video, segment, trim_time))
+            for video, segment, trim_time in zip(input_files, segments, trim_times)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        
+        list_path = work_dir / "list.txt"
+        await asyncio.to_thread(write_concat_list, segments, list_path)
+        await run_ffmpeg(
+            build_concat_demuxer_command(list_path, output_path, config, ts_segments=True),
+            total_duration, on_progress
+        )
+    finally:
+        await asyncio.to_thread(shutil.rmtree, work_dir, True)
+
+async def faststart(path: str) -> bool:
+    # Remux in place once at upload, so streaming and thumbnails seek cheaply
+    if not await asyncio.to_thread(needs_faststart, path):
+        return False
+    
+    source = Path(path)
+    tmp_path = source.with_name(f".{source.stem}.faststart{source.suffix}")
+    try:
+        async with REMUX_SEM:
+            await _run_process(build_faststart_command(path, str(tmp_path)))
+        await asyncio.to_thread(os.replace, tmp_path, source)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning("faststart remux failed for %s: %s", path, e)
+        await asyncio.to_thread(tmp_path.unlink, True)
+        return False
+    return True
\ No newline at end of file
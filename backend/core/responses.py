@@ -0,0 +1,62 @@
+import os
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+RANGE_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+def _parse_range(range_header: str, size: int):
+    # Only single byte ranges are handled, which is all <video> seeking asks for
+    units, _, spec = range_header.partition("=")
+    if units.strip() != "bytes" or "," in spec:
+        return None
+    
+    start, _, end = spec.strip().partition("-")
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # Suffix range, e.g. bytes=-500 for the last 500 bytes
+            start = max(size - int(end), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    return start, end
+
+def _iter_file_range(path, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def video_response(path, stat_result: os.stat_result, range_header: str = None, filename: str = None):
+    # Reuses a known stat_result so serving a file costs no extra stat calls
+    size = stat_result.st_size
+    headers = {"Accept-Ranges": "bytes"}
+    
+    byte_range = _parse_range(range_header, size) if range_header else None
+    if byte_range is None:
+        return FileResponse(
+            path=str(path),
+            media_type="video/mp4",
+            filename=filename,
+            stat_result=stat_result,
+            headers=headers
+        )
+    
+    start, end = byte_range
+    if start >= size or start > end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _iter_file_range(path, start, end),
+        status_code=206,
+        media_type="video/mp4",
+        headers=headers
+    )
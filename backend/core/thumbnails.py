@@ -0,0 +1,93 @@
+import asyncio
+import functools
+import logging
+import subprocess
+
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_TIME = 1.0  # Seconds in, clamped for short clips
+
+# Hardware decoders we know how to drive, in order of preference
+HWACCELS = ("cuda", "videotoolbox")
+
+logger = logging.getLogger(__name__)
+
+# Cleared after the first hardware failure so we don't keep paying for a retry
+hwaccel_enabled = True
+
+@functools.lru_cache(maxsize=1)
+def detect_hwaccel():
+    # Asked once per process, ffmpeg lists one method per line after a header
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            capture_output=True, text=True, check=True
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    
+    available = set(result.stdout.split())
+    return next((hwaccel for hwaccel in HWACCELS if hwaccel in available), None)
+
+def _thumbnail_timestamp(duration: float = None) -> float:
+    # Stay inside short clips rather than seeking past the end
+    if not duration:
+        return 0.0
+    return min(THUMBNAIL_TIME, duration / 2)
+
+def build_thumbnail_command(path: str, timestamp: float, hwaccel: str = None) -> list:
+    # -ss before -i seeks on the demuxer to the nearest keyframe (mp4 via the
+    # moov index, moved to the front at upload; mkv/webm via their cues), and ffmpeg
+    # scales and encodes the JPEG straight to stdout. Area averaging is both
+    # cheaper and sharper than the default bicubic for large downscales.
+    # Frames stay in YUV the whole way, and pinning yuvj420p means the mjpeg
+    # encoder takes them as-is (10-bit or 4:4:4 sources would otherwise be
+    # encoded at full chroma)
+    cmd = ["ffmpeg", "-v", "error"]
+    scale = f"scale='min({THUMBNAIL_WIDTH},iw)':-2:flags=area,format=yuvj420p"
+    
+    if hwaccel == "cuda":
+        # Decode and downscale on the GPU, only the small frame is copied back
+        cmd.extend(["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"])
+        scale = f"scale_cuda={THUMBNAIL_WIDTH}:-2,hwdownload,format=nv12,format=yuvj420p"
+    elif hwaccel == "videotoolbox":
+        cmd.extend(["-hwaccel", "videotoolbox"])
+    
+    cmd.extend([
+        "-ss", f"{timestamp:.3f}", "-i", path,
+        "-frames:v", "1", "-vf", scale,
+        "-q:v", "5", "-f", "image2", "-vcodec", "mjpeg", "-"
+    ])
+    return cmd
+
+async def _run_thumbnail(cmd: list, path: str):
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError:
+        logger.warning("ffmpeg not found, skipping thumbnail for %s", path)
+        return None
+    
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0 or not stdout:
+        logger.warning("Thumbnail generation failed for %s: %s", path, stderr.decode(errors="replace"))
+        return None
+    return stdout
+
+async def generate_thumbnail(path: str, duration: float = None):
+    global hwaccel_enabled
+    
+    timestamp = _thumbnail_timestamp(duration)
+    hwaccel = await asyncio.to_thread(detect_hwaccel) if hwaccel_enabled else None
+    
+    if hwaccel:
+        jpeg = await _run_thumbnail(build_thumbnail_command(path, timestamp, hwaccel), path)
+        if jpeg:
+            return jpeg
+    
+    jpeg = await _run_thumbnail(build_thumbnail_command(path, timestamp), path)
+    if hwaccel and jpeg:
+        # Listed isn't the same as usable (e.g. a CUDA build on a box without a GPU)
+        logger.info("Hardware thumbnail decode via %s failed, using software from now on", hwaccel)
+        hwaccel_enabled = False
+    return jpeg
@@ -1,25 +1,56 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from api.clips import router as clips_router
+from fastapi.responses import ORJSONResponse
+import asyncio
+import subprocess
+from api.clips import ensure_directories, router as clips_router, start_thumbnail_worker
+from core.processor import ffmpeg_pool_status
+from core.thumbnails import detect_hwaccel
 
-app = FastAPI()
+# orjson serialises the clip listings noticeably faster than the stdlib encoder
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Add CORS support for local React front end
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
 )
 
 # Include API routes
 app.include_router(clips_router)
 
+# Keeps a reference so the background task isn't garbage collected
+background_tasks = set()
+
+def warm_up():
+    # Page in the ffmpeg/ffprobe binaries and cache the hwaccel probe so the
+    # first upload doesn't pay for them
+    for binary in ("ffprobe", "ffmpeg"):
+        try:
+            subprocess.run([binary, "-version"], capture_output=True)
+        except FileNotFoundError:
+            pass
+    detect_hwaccel()
+
+@app.on_event("startup")
+async def startup():
+    # Create upload/output directories once, not on import or per request
+    ensure_directories()
+    background_tasks.add(start_thumbnail_worker())
+    background_tasks.add(asyncio.create_task(asyncio.to_thread(warm_up)))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+
 @app.get("/")
 def read_root():
     return {"message": "ClipFlow API is running"}
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy", "service": "ClipFlow API"}
\ No newline at end of file
+    return {"status": "healthy", "service": "ClipFlow API", "ffmpeg": ffmpeg_pool_status()}
\ No newline at end of file
@@ -4,8 +4,8 @@ import "./App.css";
 interface VideoClip {
   id: string;
   filename: string;
-  file_path: string;
   file_size: number;
+  duration: number | null;
 }
 
 interface ConcatResult {
@@ -49,18 +49,22 @@ function App() {
     setError("");
 
     try {
+      // Send every selected file in one request so they're probed as a batch
+      const formData = new FormData();
       for (const file of files) {
-        const formData = new FormData();
-        formData.append("file", file);
+        formData.append("files", file);
+      }
 
-        const response = await fetch("http://localhost:8000/api/clips/upload", {
+      const response = await fetch(
+        "http://localhost:8000/api/clips/upload/batch",
+        {
           method: "POST",
           body: formData,
-        });
-
-        if (!response.ok) {
-          throw new Error(`Upload failed: ${response.statusText}`);
         }
+      );
+
+      if (!response.ok) {
+        throw new Error(`Upload failed: ${response.statusText}`);
       }
 
       // Reload clips after upload
@@ -207,6 +211,8 @@ function App() {
                   width="180"
                   height="120"
                   controls
+                  preload="none"
+                  poster={`http://localhost:8000/api/clips/${clip.id}/thumbnail`}
                   style={{ marginBottom: "10px", borderRadius: "4px" }}
                   src={`http://localhost:8000/api/clips/${clip.id}/video`}
                 >